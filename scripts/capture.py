@@ -5,33 +5,53 @@ import time
 from datetime import datetime
 import argparse
 import socket
+import atexit
+import shlex
 
 LOGDIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "logs")
 LOGFILE = os.path.join(LOGDIR, "capture.log")
 CAPTURES_DIR = "./captures"
+os.makedirs(LOGDIR, exist_ok=True)
+
+# Log file handle, opened on first use and kept open for the rest of the run
+_LOG_FH = None
+
+# sh session inside capture_poc, started once and reused for every command
+_CONTAINER_SHELL = None
+_SHELL_SENTINEL = b"__END__"
+
+# How long a successful container check is trusted, keyed by container name
+CONTAINER_CHECK_TTL = 30
+_container_ok_until = {}
+
+# Markers printed by the batched tcpdump probe when it has to install tcpdump
+_TCPDUMP_INSTALLING = "__TCPDUMP_INSTALLING__"
+_TCPDUMP_INSTALLED = "__TCPDUMP_INSTALLED__"
 
 def log(msg):
-    if not os.path.exists(LOGDIR):
-        os.makedirs(LOGDIR)
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(LOGFILE, "a") as f:
-        f.write(f"[{timestamp}] {msg}\n")
-    print(f"[{timestamp}] {msg}")
+    global _LOG_FH
+    if _LOG_FH is None:
+        _LOG_FH = open(LOGFILE, "a", buffering=8192)
+        atexit.register(_LOG_FH.close)
+    lt = time.localtime()
+    timestamp = f"{lt.tm_year:04d}-{lt.tm_mon:02d}-{lt.tm_mday:02d} {lt.tm_hour:02d}:{lt.tm_min:02d}:{lt.tm_sec:02d}"
+    line = f"[{timestamp}] {msg}\n"
+    _LOG_FH.write(line)
+    print(line, end="")
 
 def run_cmd(cmd, check=True):
-    """Run a command and return stdout, stderr and return code"""
+    """Run a command and return stdout, stderr (as undecoded bytes) and return code"""
     try:
         result = subprocess.run(
             cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            check=check,
-            text=True
+            check=check
         )
         return result.stdout, result.stderr, result.returncode
     except subprocess.CalledProcessError as e:
         log(f"Command failed: {' '.join(cmd)}")
-        log(f"Error: {e.stderr}")
+        log(f"Error: {e.stderr.decode('utf-8', 'replace')}")
         if check:
             sys.exit(1)
         return e.stdout, e.stderr, e.returncode
@@ -39,27 +59,94 @@ def run_cmd(cmd, check=True):
         log(f"Exception running command: {e}")
         if check:
             sys.exit(1)
-        return "", str(e), -1
+        return b"", str(e).encode(), -1
+
+def open_container_shell(container="capture_poc"):
+    """Start a long-running sh in the container, or return the one already running"""
+    global _CONTAINER_SHELL
+    if _CONTAINER_SHELL is not None and _CONTAINER_SHELL.poll() is None:
+        return _CONTAINER_SHELL
+    try:
+        _CONTAINER_SHELL = subprocess.Popen(
+            ["docker", "exec", "-i", container, "sh"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=None
+        )
+    except Exception as e:
+        log(f"Could not open a shell in {container}: {e}")
+        _CONTAINER_SHELL = None
+    return _CONTAINER_SHELL
+
+def close_container_shell():
+    """End the container shell session, if one is open"""
+    global _CONTAINER_SHELL
+    if _CONTAINER_SHELL is None:
+        return
+    if _CONTAINER_SHELL.poll() is None:
+        try:
+            _CONTAINER_SHELL.stdin.close()
+            _CONTAINER_SHELL.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            _CONTAINER_SHELL.kill()
+    _CONTAINER_SHELL = None
+
+atexit.register(close_container_shell)
+
+def run_in_container(cmd_str):
+    """Run a shell command in the container session and return output and return code
+
+    stderr is folded into the output, which is returned as undecoded bytes.
+    The command runs in a subshell so it cannot change or exit the shared session,
+    with stdin from /dev/null so it cannot consume the sentinel from the session pipe.
+    """
+    shell = open_container_shell()
+    if shell is None:
+        return b"", -1
+
+    lines = []
+    try:
+        shell.stdin.write(f"( {cmd_str} ) </dev/null 2>&1\nprintf '\\n{_SHELL_SENTINEL.decode()}%d\\n' $?\n".encode())
+        shell.stdin.flush()
+        for line in shell.stdout:
+            rc_text = line[len(_SHELL_SENTINEL):].strip()
+            if line.startswith(_SHELL_SENTINEL) and rc_text.isdigit():
+                # Drop the newline printed ahead of the sentinel
+                return b"".join(lines)[:-1], int(rc_text)
+            # Anything else, including output that merely starts with the sentinel text
+            lines.append(line)
+    except (OSError, ValueError) as e:
+        log(f"Exception running command in container: {e}")
+
+    # The session ended before the sentinel came back; the container may be gone
+    close_container_shell()
+    _container_ok_until.clear()
+    return b"".join(lines), -1
 
 def check_container_running(container="capture_poc"):
     """Check if container is running"""
+    now = time.monotonic()
+    if now < _container_ok_until.get(container, 0.0):
+        return True
+
     stdout, stderr, rc = run_cmd(["docker", "ps", "-q", "-f", f"name={container}"], check=False)
-    if not stdout.strip():
+    if stdout.strip() == b"":
         log(f"Container {container} is not running! Please start it with 'docker compose up -d'")
         return False
+    if open_container_shell(container) is None:
+        return False
+
+    _container_ok_until[container] = now + CONTAINER_CHECK_TTL
     return True
 
 def list_interfaces():
     if not check_container_running():
         return
 
-    stdout, stderr, rc = run_cmd(
-        ["docker", "exec", "capture_poc", "ip", "link"],
-        check=False
-    )
+    output, rc = run_in_container("ip link")
 
     if rc == 0:
-        interfaces = stdout.replace('\r', ' ').replace('\n', ' ')
+        interfaces = output.decode("utf-8", "replace").replace('\r', ' ').replace('\n', ' ')
         log("Available interfaces in capture_poc: " + interfaces)
     else:
         log("Could not list interfaces in capture_poc.")
@@ -68,45 +155,40 @@ def check_tcpdump():
     if not check_container_running():
         return False
 
-    stdout, stderr, rc = run_cmd(
-        ["docker", "exec", "capture_poc", "which", "tcpdump"],
-        check=False
+    # Probe, install if missing and print the version in one round trip
+    output, rc = run_in_container(
+        "if ! command -v tcpdump >/dev/null; then "
+        f"echo {_TCPDUMP_INSTALLING}; apk add tcpdump >/dev/null || exit 1; echo {_TCPDUMP_INSTALLED}; "
+        "fi; tcpdump --version"
     )
 
-    if rc != 0:
+    lines = output.decode("utf-8", "replace").splitlines()
+    markers = {line for line in lines if line in (_TCPDUMP_INSTALLING, _TCPDUMP_INSTALLED)}
+    output_text = "\n".join(line for line in lines if line not in markers)
+
+    if _TCPDUMP_INSTALLING in markers:
         log("tcpdump not found in capture_poc container.")
         log("Installing tcpdump...")
-        stdout, stderr, rc = run_cmd(
-            ["docker", "exec", "capture_poc", "apk", "add", "tcpdump"],
-            check=False
-        )
-        if rc != 0:
-            log("Failed to install tcpdump. Error: " + stderr)
+        if _TCPDUMP_INSTALLED not in markers:
+            log("Failed to install tcpdump. Error: " + output_text)
             return False
         log("tcpdump installed successfully.")
 
-    stdout, stderr, rc = run_cmd(
-        ["docker", "exec", "capture_poc", "tcpdump", "--version"],
-        check=False
-    )
-
     if rc == 0:
-        version_output = stdout.replace('\r', ' ').replace('\n', ' ')
+        version_output = output_text.replace('\r', ' ').replace('\n', ' ')
         log("tcpdump version output: " + version_output)
         return True
     else:
-        log("Failed to get tcpdump version. Error: " + stderr)
+        log("Failed to get tcpdump version. Error: " + output_text)
         return False
 
 def ensure_capture_dir():
     """Ensure capture directory exists"""
-    if not os.path.exists(CAPTURES_DIR):
-        try:
-            os.makedirs(CAPTURES_DIR)
-            log(f"Created captures directory: {CAPTURES_DIR}")
-        except Exception as e:
-            log(f"Error creating captures directory: {e}")
-            return False
+    try:
+        os.makedirs(CAPTURES_DIR, exist_ok=True)
+    except Exception as e:
+        log(f"Error creating captures directory: {e}")
+        return False
     return True
 
 def start_tcpdump(interface="any", pcap_name="test.pcap"):
@@ -123,14 +205,14 @@ def start_tcpdump(interface="any", pcap_name="test.pcap"):
 
     container_pcap_path = f"/captures/{pcap_name}"
 
-    stdout, stderr, rc = run_cmd(
-        ["docker", "exec", "-d", "capture_poc", "tcpdump", "-i", interface,
-         "-w", container_pcap_path, "not", "port", "22"],
-        check=False
+    # Detach tcpdump from the session's pipes so it outlives this process
+    output, rc = run_in_container(
+        f"nohup tcpdump -i {shlex.quote(interface)} -w {shlex.quote(container_pcap_path)} "
+        "not port 22 >/dev/null 2>&1 &"
     )
 
     if rc != 0:
-        log(f"Failed to start tcpdump in capture_poc on interface {interface}. Error: {stderr}")
+        log(f"Failed to start tcpdump in capture_poc on interface {interface}. Error: {output.decode('utf-8', 'replace')}")
         return False
 
     log(f"tcpdump started in capture_poc on interface {interface} -> {container_pcap_path}")
@@ -145,17 +227,21 @@ def stop_tcpdump(quiet=False):
     if not check_container_running():
         return False
 
-    stdout, stderr, rc = run_cmd(
-        ["docker", "exec", "capture_poc", "pkill", "-INT", "tcpdump"],
-        check=False
+    # Signal tcpdump and give it up to 2 seconds to finish writing, in one round trip.
+    # Exits 1 if nothing was signalled and 2 if tcpdump is still running afterwards.
+    output, rc = run_in_container(
+        "pkill -INT tcpdump || exit 1; i=0; "
+        "while pgrep -x tcpdump >/dev/null && [ $i -lt 20 ]; do sleep 0.1; i=$((i + 1)); done; "
+        "if pgrep -x tcpdump >/dev/null; then exit 2; fi"
     )
 
+    if rc == 2:
+        # Copying now would move the pcap away while tcpdump is still writing it
+        log("tcpdump in capture_poc did not exit within 2 seconds; not copying the capture")
+        return False
     if rc != 0 and not quiet:
         log("Failed to send SIGINT to tcpdump in capture_poc (it may not be running)")
 
-    # Give it a moment to finish writing
-    time.sleep(2)
-
     # Try to get current capture filename
     current_capture = "test.pcap"
     current_capture_file = os.path.join(CAPTURES_DIR, ".current_capture")
@@ -169,22 +255,38 @@ def copy_pcap(pcap_name="test.pcap"):
     if not check_container_running() or not ensure_capture_dir():
         return False
 
-    stdout, stderr, rc = run_cmd(
-        ["docker", "cp", f"capture_poc:/captures/{pcap_name}", f"{CAPTURES_DIR}/{pcap_name}"],
-        check=False
-    )
+    host_pcap_path = f"{CAPTURES_DIR}/{pcap_name}"
+    partial_path = f"{host_pcap_path}.part"
 
-    if rc != 0:
-        log(f"Failed to copy {pcap_name} from capture_poc. Error: {stderr}")
-        return False
+    # Stream the pcap out with cat rather than docker cp's tar/untar round trip.
+    # ./captures is also mounted at /captures, so write to a side file and
+    # rename it; truncating the destination directly could empty the source.
+    try:
+        with open(partial_path, "wb") as f:
+            result = subprocess.run(
+                ["docker", "exec", "capture_poc", "cat", f"/captures/{pcap_name}"],
+                stdout=f,
+                stderr=subprocess.PIPE,
+                check=False
+            )
+            size = f.tell()
+
+        if result.returncode != 0:
+            _container_ok_until.clear()
+            log(f"Failed to copy {pcap_name} from capture_poc. Error: {result.stderr.decode('utf-8', 'replace')}")
+            return False
 
-    if os.path.exists(f"{CAPTURES_DIR}/{pcap_name}"):
-        size = os.path.getsize(f"{CAPTURES_DIR}/{pcap_name}")
-        log(f"{pcap_name} copied to {CAPTURES_DIR} ({size} bytes)")
-        return True
-    else:
-        log(f"{pcap_name} not found in {CAPTURES_DIR}")
+        os.replace(partial_path, host_pcap_path)
+    except Exception as e:
+        log(f"Exception copying {pcap_name} from capture_poc: {e}")
         return False
+    finally:
+        # Only left behind when the copy did not make it into place
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+    log(f"{pcap_name} copied to {CAPTURES_DIR} ({size} bytes)")
+    return True
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Start or stop packet capture.")
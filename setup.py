@@ -1,16 +1,19 @@
+from pathlib import Path
+
 from setuptools import setup, find_packages
 
 setup(
     name="proxy-ja4-project",
     version="1.0.0",
     description="Automated JA4 signature collection from TLS-inspecting proxies for proxy detection",
-    long_description=open("README.md").read(),
+    long_description=Path(__file__).parent.joinpath("README.md").read_text(encoding="utf-8"),
     long_description_content_type="text/markdown",
     packages=find_packages(),
     install_requires=[
         "cryptography>=41.0.0",
         "requests>=2.28.0",
         "pyyaml>=6.0",
+        "orjson>=3.0",
     ],
     python_requires=">=3.8",
     author="Your Name",
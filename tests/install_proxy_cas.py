@@ -1,9 +1,15 @@
 import shutil
+import hashlib
 import os
 import time
 import sys
 from datetime import datetime, timezone
 import platform
+import subprocess
+import atexit
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from cryptography import x509
 from cryptography.x509.oid import NameOID
@@ -11,19 +17,56 @@ from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.backends import default_backend
 
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 LOGDIR = os.path.join(PROJECT_ROOT, "logs")
 LOGFILE = os.path.join(LOGDIR, "install_proxy_cas.log")
 SHARED_CA_DIR = os.path.join(PROJECT_ROOT, "configs", "squid", "runtime")
 CA_KEY = os.path.join(SHARED_CA_DIR, "proxy-ca.key.pem")
 CA_CERT = os.path.join(SHARED_CA_DIR, "proxy-ca.cert.pem")
+IS_LINUX = platform.system() == "Linux"
+os.makedirs(LOGDIR, exist_ok=True)
+
+# Longest wait_for_file() sleeps between checks when no inotify event arrives
+WAIT_POLL_INTERVAL = 2
+
+# Log file handle, opened on first use and flushed every LOG_FLUSH_EVERY lines
+LOG_FLUSH_EVERY = 20
+_LOG_FH = None
+_LOG_PENDING = 0
+_LOG_LOCK = threading.Lock()
+
+# Set when install_ca() changes the trust store, so update-ca-certificates only runs when
+# needed; it stays set until an update succeeds
+_CA_STORE_CHANGED = False
+# Where update-ca-certificates links each installed CA as <name>.pem
+CA_BUNDLE_LINK_DIR = "/etc/ssl/certs"
 
 def log(msg):
-    if not os.path.exists(LOGDIR):
-        os.makedirs(LOGDIR)
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(LOGFILE, "a") as f:
-        f.write(f"[{timestamp}] {msg}\n")
+    global _LOG_FH, _LOG_PENDING
+    if _LOG_FH is None:
+        _LOG_FH = open(LOGFILE, "a", buffering=8192)
+        atexit.register(_LOG_FH.close)
+    lt = time.localtime()
+    timestamp = f"{lt.tm_year:04d}-{lt.tm_mon:02d}-{lt.tm_mday:02d} {lt.tm_hour:02d}:{lt.tm_min:02d}:{lt.tm_sec:02d}"
+    with _LOG_LOCK:
+        _LOG_FH.write(f"[{timestamp}] {msg}\n")
+        _LOG_PENDING += 1
+        if _LOG_PENDING >= LOG_FLUSH_EVERY:
+            _LOG_FH.flush()
+            _LOG_PENDING = 0
+
+def flush_log():
+    """Push buffered log lines to disk"""
+    global _LOG_PENDING
+    with _LOG_LOCK:
+        if _LOG_FH is not None:
+            _LOG_FH.flush()
+        _LOG_PENDING = 0
 
 def ensure_directories_and_files():
     """Ensure all necessary directories and configuration files exist"""
@@ -37,19 +80,17 @@ def ensure_directories_and_files():
     ]
     
     for directory in directories_to_create:
-        if not os.path.exists(directory):
-            try:
-                os.makedirs(directory)
-                log(f"Created directory: {directory}")
-            except Exception as e:
-                log(f"ERROR: Could not create directory {directory}: {e}")
-                return False
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except Exception as e:
+            log(f"ERROR: Could not create directory {directory}: {e}")
+            return False
     
     # Create squid configuration file if it doesn't exist
     squid_conf_path = os.path.join(PROJECT_ROOT, "configs", "squid", "runtime", "squid_no_ssl.conf")
     if not os.path.exists(squid_conf_path):
         try:
-            squid_conf_content = """# Squid configuration for basic HTTP proxy
+            squid_conf_content = b"""# Squid configuration for basic HTTP proxy
 http_port 3128
 
 # Basic logging
@@ -63,7 +104,7 @@ maximum_object_size 4096 KB
 # Allow all requests
 http_access allow all
 """
-            with open(squid_conf_path, "w") as f:
+            with open(squid_conf_path, "wb") as f:
                 f.write(squid_conf_content)
             log(f"Created squid configuration file: {squid_conf_path}")
         except Exception as e:
@@ -81,9 +122,12 @@ def generate_ca():
     if not (os.path.exists(CA_KEY) and os.path.exists(CA_CERT)):
         log("Generating new CA key and certificate using cryptography...")
         try:
+            # 2048 bits is plenty for a throwaway test CA and generates far
+            # faster than 4096. Squid signs bumped certificates with this key,
+            # so it stays RSA for client compatibility.
             key = rsa.generate_private_key(
                 public_exponent=65537,
-                key_size=4096,
+                key_size=2048,
                 backend=default_backend()
             )
             subject = issuer = x509.Name([
@@ -124,23 +168,35 @@ def generate_ca():
 def find_ca_files(directory, patterns):
     found = []
     if os.path.exists(directory):
-        for fname in os.listdir(directory):
-            for pat in patterns:
-                if fname.lower().endswith(pat):
-                    found.append(os.path.join(directory, fname))
+        suffixes = tuple(patterns)
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.lower().endswith(suffixes) and entry.is_file():
+                    found.append(entry.path)
     return found
 
+def file_sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
 def install_ca(src, dst_name):
+    global _CA_STORE_CHANGED
     if os.path.exists(src):
         dst_dir = "/usr/local/share/ca-certificates"
-        if not os.path.exists(dst_dir):
-            try:
-                os.makedirs(dst_dir)
-            except Exception as e:
-                log(f"Failed to create {dst_dir}: {e}")
-                return False
+        try:
+            os.makedirs(dst_dir, exist_ok=True)
+        except Exception as e:
+            log(f"Failed to create {dst_dir}: {e}")
+            return False
         dst = os.path.join(dst_dir, dst_name)
+        # Only skip when the copy matches and a previous update linked it into the bundle
+        bundle_link = os.path.join(CA_BUNDLE_LINK_DIR, os.path.splitext(dst_name)[0] + ".pem")
+        if (os.path.exists(dst) and file_sha256(dst) == file_sha256(src)
+                and os.path.exists(bundle_link)):
+            log(f"{dst} is already up to date")
+            return True
         shutil.copy(src, dst)
+        _CA_STORE_CHANGED = True
         log(f"Copied {src} to {dst}")
         return True
     else:
@@ -150,38 +206,95 @@ def install_ca(src, dst_name):
 def is_valid_pem_cert(cert_path):
     if not os.path.exists(cert_path):
         return False
+    # A sentinel holding the cert's size and mtime records that this exact file already passed
+    sentinel = cert_path + ".validated"
+    st = os.stat(cert_path)
+    cert_stamp = f"{st.st_size} {st.st_mtime_ns}"
+    try:
+        with open(sentinel, "r") as f:
+            if f.read() == cert_stamp:
+                return True
+    except OSError:
+        pass
     try:
         with open(cert_path, "rb") as f:
             data = f.read()
             if not data.strip():
                 return False
             x509.load_pem_x509_certificate(data, default_backend())
-        return True
     except Exception as e:
         log(f"PEM certificate validation failed for {cert_path}: {e}")
         return False
+    try:
+        with open(sentinel, "w") as f:
+            f.write(cert_stamp)
+    except OSError as e:
+        log(f"Could not record validation of {cert_path}: {e}")
+    return True
+
+def watch_directory(directory):
+    """Return an inotify watch for files finished in directory, or None to poll instead"""
+    if INotify is None or not IS_LINUX:
+        return None
+    try:
+        inotify = INotify()
+        inotify.add_watch(directory, flags.CLOSE_WRITE | flags.MOVED_TO)
+        return inotify
+    except OSError as e:
+        log(f"Cannot watch {directory}, polling instead: {e}")
+        return None
+
+def file_ready(file_path):
+    """Check that a file exists and has content, so a half-created one is not copied"""
+    try:
+        return os.path.getsize(file_path) > 0
+    except OSError:
+        return False
 
 def wait_for_file(file_path, max_wait=60):
-    """Wait for a file to exist"""
+    """Wait for a file to exist and be non-empty"""
     log(f"Waiting for {file_path}...")
-    start_time = time.time()
-    
-    while not os.path.exists(file_path):
-        if time.time() - start_time > max_wait:
-            log(f"Timeout waiting for {file_path}")
-            return False
-        time.sleep(2)
+    flush_log()
+    if file_ready(file_path):
+        log(f"Found {file_path}")
+        return True
+
+    deadline = time.monotonic() + max_wait
+    inotify = watch_directory(os.path.dirname(file_path))
+    try:
+        while not file_ready(file_path):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                log(f"Timeout waiting for {file_path}")
+                return False
+            # Events only wake us early; bind mounts on some hosts never deliver
+            # them, so the read is still bounded by the poll interval
+            timeout = min(remaining, WAIT_POLL_INTERVAL)
+            if inotify is not None:
+                inotify.read(timeout=int(timeout * 1000))
+            else:
+                time.sleep(timeout)
+    finally:
+        if inotify is not None:
+            inotify.close()
     
     log(f"Found {file_path}")
     return True
 
 def auto_install_all_cas():
     """Automatically install all CA certificates with waiting"""
+    global _CA_STORE_CHANGED
     log("Starting automatic CA certificate installation...")
     
-    # Wait for and install mitmproxy CA
+    # Wait for both proxies' CAs at the same time
     mitm_ca_path = "/mitm_ca/mitmproxy-ca-cert.pem"
-    if wait_for_file(mitm_ca_path):
+    squid_ca_path = "/shared_ca_cert.pem"
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        mitm_ca_ready = executor.submit(wait_for_file, mitm_ca_path)
+        squid_ca_ready = executor.submit(wait_for_file, squid_ca_path)
+    
+    # Install mitmproxy CA
+    if mitm_ca_ready.result():
         if install_ca(mitm_ca_path, "mitmproxy-ca.crt"):
             log("mitmproxy CA certificate installed successfully")
         else:
@@ -189,9 +302,8 @@ def auto_install_all_cas():
     else:
         log("mitmproxy CA certificate not found within timeout")
     
-    # Wait for and install Squid CA
-    squid_ca_path = "/shared_ca_cert.pem"
-    if wait_for_file(squid_ca_path):
+    # Install Squid CA
+    if squid_ca_ready.result():
         if install_ca(squid_ca_path, "squid-ca.crt"):
             log("Squid CA certificate installed successfully")
         else:
@@ -199,13 +311,13 @@ def auto_install_all_cas():
     else:
         log("Squid CA certificate not found within timeout")
     
-    # Update CA certificates if we're on Linux
-    if platform.system() == "Linux":
+    # Update CA certificates if we're on Linux and a certificate changed
+    if IS_LINUX and _CA_STORE_CHANGED:
         try:
-            import subprocess
             subprocess.run(["update-ca-certificates"], check=True)
+            _CA_STORE_CHANGED = False
             log("CA certificates updated successfully")
-        except subprocess.CalledProcessError as e:
+        except (OSError, subprocess.CalledProcessError) as e:
             log(f"Failed to update CA certificates: {e}")
     
     log("Automatic CA installation complete!")
@@ -228,12 +340,17 @@ else:
     log(f"CA certificate {CA_CERT} is valid.")
 
 # Step 2: Install CA cert to client trust store (only on Linux)
-if platform.system() == "Linux":
+if IS_LINUX:
     ca_installed = install_ca(CA_CERT, "proxy-ja4-ca.crt")
-    if ca_installed:
-        import subprocess
-        subprocess.run(["update-ca-certificates"])
-        log("CA certificates updated.")
+    if ca_installed and _CA_STORE_CHANGED:
+        try:
+            subprocess.run(["update-ca-certificates"], check=True)
+            _CA_STORE_CHANGED = False
+            log("CA certificates updated.")
+        except (OSError, subprocess.CalledProcessError) as e:
+            log(f"Failed to update CA certificates: {e}")
+    elif ca_installed:
+        log("CA certificates already up to date.")
     else:
         log("No CA certificate found to install.")
 else:
@@ -242,12 +359,19 @@ else:
 # Check if we're running in auto-install mode
 if len(sys.argv) > 1 and sys.argv[1] == "--auto":
     log("Running in automatic mode - waiting for proxy CA certificates...")
+    # Exit cleanly on docker stop, including while still waiting for the CAs
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
     auto_install_all_cas()
     
     # Keep the script running to maintain the container
     log("CA installation complete. Container ready for testing.")
-    while True:
-        time.sleep(3600)  # Sleep for 1 hour
+    flush_log()
+    if IS_LINUX:
+        # Sleep in the kernel until docker stop sends SIGTERM
+        signal.pause()
+    else:
+        while True:
+            time.sleep(3600)  # Sleep for 1 hour
 else:
     # Manual mode - verify CA files were generated
     log("Running in manual mode - verifying CA files...")
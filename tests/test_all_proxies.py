@@ -11,9 +11,10 @@ This script tests each proxy and collects JA4 signatures for analysis.
 import os
 import sys
 import time
-import json
+import orjson
 import subprocess
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
 
@@ -54,9 +55,13 @@ PROXIES = [
     }
 ]
 
+# Every (proxy, host) pair is independent, so run them all at once
+MAX_WORKERS = 12
+
 def log(message):
     """Log message with timestamp"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    lt = time.localtime()
+    timestamp = f"{lt.tm_year:04d}-{lt.tm_mon:02d}-{lt.tm_mday:02d} {lt.tm_hour:02d}:{lt.tm_min:02d}:{lt.tm_sec:02d}"
     print(f"[{timestamp}] {message}")
 
 def check_proxy_health(proxy_name, port):
@@ -90,14 +95,11 @@ def check_proxy_health(proxy_name, port):
         log(f"Health check failed for {proxy_name}: {e}")
         return False
 
-def test_proxy(proxy_config):
-    """Test a single proxy configuration"""
+def check_proxy(proxy_config):
+    """Announce a proxy configuration and check its health"""
     proxy_name = proxy_config["name"]
-    log(f"Testing {proxy_name}: {proxy_config['description']}")
-    
-    results = []
+    log(f"Checking {proxy_name}: {proxy_config['description']}")
     
-    # Check proxy health first
     if proxy_name != "direct":
         port_mapping = {
             "squid": 3129,
@@ -106,104 +108,125 @@ def test_proxy(proxy_config):
         
         if not check_proxy_health(proxy_name, port_mapping[proxy_name]):
             log(f"Warning: {proxy_name} health check failed, but continuing with test")
+
+def test_one(proxy_config, host):
+    """Test a single host through a single proxy configuration"""
+    proxy_name = proxy_config["name"]
+    log(f"  Testing {host} through {proxy_name}")
     
-    # Test each host
-    for host in TEST_HOSTS:
-        log(f"  Testing {host} through {proxy_name}")
+    try:
+        # Set proxy environment if specified
+        env = os.environ.copy()
+        if proxy_config.get("env"):
+            env.update(proxy_config["env"])
         
-        try:
-            # Set proxy environment if specified
-            env = os.environ.copy()
-            if proxy_config.get("env"):
-                env.update(proxy_config["env"])
-            
-            # Make request using curl
-            cmd = ["curl", "-sS", "-D", "/dev/stderr", "-o", "/dev/null", 
-                   host, "--max-time", "15"]
-            
-            result = subprocess.run(
-                cmd, 
-                env=env if proxy_config.get("env") else None,
-                capture_output=True, 
-                text=True,
-                check=False
-            )
-            
-            success = result.returncode == 0
-            log(f"    {'✓' if success else '✗'} {host} - {'Success' if success else 'Failed'}")
-            
-            results.append({
-                "proxy": proxy_name,
-                "url": host,
-                "success": success,
-                "return_code": result.returncode,
-                "stderr": result.stderr if not success else None,
-                "timestamp": datetime.now().isoformat()
-            })
-            
-        except Exception as e:
-            log(f"    ✗ {host} - Exception: {e}")
-            results.append({
-                "proxy": proxy_name,
-                "url": host,
-                "success": False,
-                "error": str(e),
-                "timestamp": datetime.now().isoformat()
-            })
-    
-    return results
+        # Make request using curl; its ClientHello is the fingerprint being captured,
+        # so the client must stay the same for results to compare across runs
+        cmd = ["curl", "-sS", "-D", "/dev/stderr", "-o", "/dev/null", 
+               host, "--max-time", "15"]
+        
+        result = subprocess.run(
+            cmd, 
+            env=env if proxy_config.get("env") else None,
+            capture_output=True, 
+            text=True,
+            check=False
+        )
+        
+        success = result.returncode == 0
+        log(f"    {'✓' if success else '✗'} {host} through {proxy_name} - {'Success' if success else 'Failed'}")
+        
+        return {
+            "proxy": proxy_name,
+            "url": host,
+            "success": success,
+            "return_code": result.returncode,
+            "stderr": result.stderr if not success else None,
+            "timestamp": datetime.now()
+        }
+        
+    except Exception as e:
+        log(f"    ✗ {host} through {proxy_name} - Exception: {e}")
+        return {
+            "proxy": proxy_name,
+            "url": host,
+            "success": False,
+            "error": str(e),
+            "timestamp": datetime.now()
+        }
+
+def write_record(fh, record):
+    """Append one compact JSON record to a binary JSONL results file"""
+    fh.write(orjson.dumps(record) + b"\n")
 
 def run_all_tests():
-    """Run tests for all proxies"""
+    """Run tests for all proxies, streaming each result to a JSONL file"""
     log("Starting comprehensive proxy test suite")
     log(f"Testing {len(PROXIES)} proxy configurations")
     log(f"Testing {len(TEST_HOSTS)} hosts per proxy")
     
-    all_results = []
-    
     for proxy_config in PROXIES:
+        check_proxy(proxy_config)
+    
+    results_file = project_root / "captures" / "comprehensive_test_results.jsonl"
+    results_file.parent.mkdir(exist_ok=True)
+    
+    # Only per-proxy counts are kept in memory; every result goes straight to disk
+    jobs = [(proxy_config, host) for proxy_config in PROXIES for host in TEST_HOSTS]
+    tallies = {proxy_config["name"]: {"passed": 0, "total": 0} for proxy_config in PROXIES}
+    
+    with open(results_file, 'wb') as fh:
+        # Header line describing the run
+        write_record(fh, {
+            "test_run": {
+                "timestamp": datetime.now(),
+                "total_proxies": len(PROXIES),
+                "total_tests": len(jobs)
+            },
+            "proxy_configs": PROXIES,
+            "test_hosts": TEST_HOSTS
+        })
+        
+        # Run every host against every proxy concurrently; records land in completion order
         log(f"\n{'='*60}")
-        proxy_results = test_proxy(proxy_config)
-        all_results.extend(proxy_results)
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(jobs))) as executor:
+            futures = [
+                executor.submit(test_one, proxy_config, host)
+                for proxy_config, host in jobs
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                write_record(fh, result)
+                tally = tallies[result["proxy"]]
+                tally["total"] += 1
+                tally["passed"] += result["success"]
         
-        # Summary for this proxy
-        success_count = sum(1 for r in proxy_results if r["success"])
-        total_count = len(proxy_results)
-        log(f"Proxy {proxy_config['name']}: {success_count}/{total_count} tests passed")
+        # Footer line with the totals
+        write_record(fh, {
+            "summary": {
+                "timestamp": datetime.now(),
+                "total_tests": sum(t["total"] for t in tallies.values()),
+                "successful_tests": sum(t["passed"] for t in tallies.values()),
+                "proxies": tallies
+            }
+        })
+    
+    # Summary for each proxy
+    for proxy_name, tally in tallies.items():
+        log(f"Proxy {proxy_name}: {tally['passed']}/{tally['total']} tests passed")
     
     # Overall summary
     log(f"\n{'='*60}")
     log("OVERALL TEST SUMMARY")
     log(f"{'='*60}")
     
-    for proxy_config in PROXIES:
-        proxy_name = proxy_config["name"]
-        proxy_results = [r for r in all_results if r["proxy"] == proxy_name]
-        success_count = sum(1 for r in proxy_results if r["success"])
-        total_count = len(proxy_results)
-        log(f"{proxy_name:12}: {success_count:2}/{total_count} tests passed")
-    
-    # Save results
-    results_file = project_root / "captures" / "comprehensive_test_results.json"
-    results_file.parent.mkdir(exist_ok=True)
-    
-    with open(results_file, 'w') as f:
-        json.dump({
-            "test_run": {
-                "timestamp": datetime.now().isoformat(),
-                "total_proxies": len(PROXIES),
-                "total_tests": len(all_results),
-                "successful_tests": sum(1 for r in all_results if r["success"])
-            },
-            "proxy_configs": PROXIES,
-            "test_hosts": TEST_HOSTS,
-            "results": all_results
-        }, f, indent=2)
+    for proxy_name, tally in tallies.items():
+        log(f"{proxy_name:12}: {tally['passed']:2}/{tally['total']} tests passed")
     
     log(f"\nDetailed results saved to: {results_file}")
     log("Test suite completed!")
     
-    return all_results
+    return tallies
 
 def main():
     """Main entry point"""
@@ -214,10 +237,10 @@ def main():
         return
     
     try:
-        results = run_all_tests()
+        tallies = run_all_tests()
         
         # Exit with error code if any tests failed
-        failed_tests = sum(1 for r in results if not r["success"])
+        failed_tests = sum(t["total"] - t["passed"] for t in tallies.values())
         if failed_tests > 0:
             log(f"Warning: {failed_tests} tests failed")
             sys.exit(1)